@@ -1,30 +1,48 @@
-import json
+from dataclasses import dataclass
 from datetime import datetime, timedelta
-from typing import Literal
+from typing import Iterator, Literal
 
+import ijson
+import orjson
 from loguru import logger
-from pydantic import BaseModel
 
+WRITE_CHUNK_SIZE = 4 * 1024 * 1024
 
-class Message(BaseModel):
-    date: datetime
+
+@dataclass(slots=True)
+class Message:
+    date: float  # POSIX timestamp
     author: str
     text: str
 
 
-class Chat(BaseModel):
+@dataclass(slots=True)
+class Chat:
     name: str
     type: Literal["personal_chat", "private_group", "private_supergroup"]
     messages: list[Message]
-    sessions: list[list[Message]] = []
+
+
+def _message_text(msg: dict) -> str:
+    text_entities = msg["text_entities"]
+    if not text_entities:
+        text = ""
+    elif len(text_entities) == 1:
+        text = text_entities[0]["text"]
+    else:
+        text = "".join([text_entity["text"] for text_entity in text_entities])
+    sticker_emoji = msg.get("sticker_emoji")
+    return text + sticker_emoji if sticker_emoji else text
 
 
 def load_chats(path: str) -> tuple[list[Chat], tuple[int | None, str | None]]:
     chats: list[Chat] = []
+    # Share one string object per author across all of their messages
+    authors: dict[str, str] = {}
     target_id, target_name = None, None
     logger.info(f"Loading chats from '{path}'...")
-    with open(path, "r") as f:
-        for chat in json.load(f)["chats"]["list"]:
+    with open(path, "rb") as f:
+        for chat in ijson.items(f, "chats.list.item"):
             # It means we encountered 'Saved Messages', from which we can extract id and a name of a target person
             if "name" not in chat:
                 target_id = int(chat["id"])
@@ -35,19 +53,14 @@ def load_chats(path: str) -> tuple[list[Chat], tuple[int | None, str | None]]:
                         if msg["from_id"] == f"user{target_id}"
                     )["from"]
                 )
+                target_name = authors.setdefault(target_name, target_name)
             # If chat does not contain name that means we encountered "Deleted Account"
             elif chat["name"]:
                 messages = [
                     Message(
-                        date=msg["date"],
-                        author=msg["from"],
-                        text="".join(
-                            [
-                                text_entity["text"]
-                                for text_entity in msg["text_entities"]
-                            ]
-                        )
-                        + msg.get("sticker_emoji", ""),
+                        date=datetime.fromisoformat(msg["date"]).timestamp(),
+                        author=authors.setdefault(msg["from"], msg["from"]),
+                        text=_message_text(msg),
                     )
                     for msg in chat["messages"]
                     if "from" in msg
@@ -75,82 +88,81 @@ def transform_chats(
     target_name = target_name or extracted_target_name
     logger.info(f"Preparing dataset for user with name '{target_name}'...")
 
-    cutoff_date = datetime.now() - timedelta(days=last_x_months * 30)
-    chats = [
-        chat
-        for chat in chats
-        if (
-            filtered_messages := [
-                msg for msg in chat.messages if msg.date > cutoff_date
-            ]
-        )
-        and setattr(chat, "messages", filtered_messages)
-    ]
+    cutoff_date = (datetime.now() - timedelta(days=last_x_months * 30)).timestamp()
+    for chat in chats:
+        chat.messages = [msg for msg in chat.messages if msg.date > cutoff_date]
+    chats = [chat for chat in chats if chat.messages]
     logger.info(f"After filtering by date, there are {len(chats)} chats left")
 
-    for chat in chats:
-        chat.sessions = create_sessions(chat.messages, session_minutes_threshold)
-        chat.sessions = combine_consecutive_messages(
-            chat.sessions, concat_one_user_messages_delimeter
-        )
-        chat.sessions = [
-            session
-            for session in chat.sessions
-            if any(msg.author == target_name for msg in session[1:])
-        ]
-
-    all_sessions = [session for chat in chats for session in chat.sessions]
-    session_dicts = [
-        {
-            "text": "\n".join(
-                f"<|im_start|>{msg.author}\n{msg.text}<|im_end|>" for msg in session
+    sessions_count = 0
+    buffer = bytearray()
+    with open(output, "wb") as f:
+        for chat in chats:
+            for text in process_chat(
+                chat,
+                session_minutes_threshold,
+                concat_one_user_messages_delimeter,
+                target_name,
+            ):
+                buffer += b'{"text":'
+                buffer += orjson.dumps(text)
+                buffer += b"}\n"
+                sessions_count += 1
+                if len(buffer) >= WRITE_CHUNK_SIZE:
+                    f.write(buffer)
+                    buffer.clear()
+        f.write(buffer)
+    logger.info(f"Took {sessions_count} chat sessions and wrote them to '{output}'.")
+
+
+def process_chat(
+    chat: Chat,
+    session_minutes_threshold: int,
+    delimiter: str,
+    target_name: str | None,
+) -> Iterator[str]:
+    for session in create_sessions(chat.messages, session_minutes_threshold):
+        session = combine_consecutive_messages(session, delimiter)
+        # Only leave sessions in which target person replies to someone
+        if any(msg.author == target_name for msg in session[1:]):
+            yield "\n".join(
+                [f"<|im_start|>{msg.author}\n{msg.text}<|im_end|>" for msg in session]
             )
-        }
-        for session in all_sessions
-    ]
-
-    with open(output, "w", encoding="utf-8") as f:
-        for session in session_dicts:
-            json.dump(session, f, ensure_ascii=False)
-            f.write("\n")
-    logger.info(f"Took {len(all_sessions)} chat sessions and wrote them to '{output}'.")
-
-
-def create_sessions(messages: list[Message], threshold: int) -> list[list[Message]]:
-    sessions = []
-    current_session = []
-    for msg in messages:
-        if (
-            not current_session
-            or (msg.date - current_session[-1].date).seconds / 60 < threshold
-        ):
-            current_session.append(msg)
-        else:
-            sessions.append(current_session)
-            current_session = [msg]
-    if current_session:
-        sessions.append(current_session)
-    return sessions
+
+
+def create_sessions(messages: list[Message], threshold: int) -> Iterator[list[Message]]:
+    if not messages:
+        return
+    threshold_seconds = threshold * 60
+    session_start = 0
+    prev_date = messages[0].date
+    for i in range(1, len(messages)):
+        date = messages[i].date
+        if date - prev_date >= threshold_seconds:
+            yield messages[session_start:i]
+            session_start = i
+        prev_date = date
+    yield messages[session_start:]
 
 
 def combine_consecutive_messages(
-    sessions: list[list[Message]], delimiter: str
-) -> list[list[Message]]:
-    combined_sessions = []
-    for session in sessions:
-        combined_session = []
-        current_message = session[0]
-        current_message.text = delimiter.lstrip() + current_message.text
-        for msg in session[1:]:
-            if msg.author == current_message.author:
-                current_message.text += delimiter + msg.text
-            else:
-                combined_session.append(current_message)
-                current_message = msg
-                current_message.text = delimiter.lstrip() + current_message.text
-        combined_session.append(current_message)
-        combined_sessions.append(combined_session)
-    return combined_sessions
+    session: list[Message], delimiter: str
+) -> list[Message]:
+    first_delimiter = delimiter.lstrip()
+    combined_session = []
+    current_message = session[0]
+    text_parts = [first_delimiter, current_message.text]
+    for msg in session[1:]:
+        if msg.author == current_message.author:
+            text_parts += (delimiter, msg.text)
+        else:
+            current_message.text = "".join(text_parts)
+            combined_session.append(current_message)
+            current_message = msg
+            text_parts = [first_delimiter, current_message.text]
+    current_message.text = "".join(text_parts)
+    combined_session.append(current_message)
+    return combined_session
 
 
 if __name__ == "__main__":